@@ -5,24 +5,76 @@ Automatically registers for pickleball open play sessions
 """
 
 import argparse
+import atexit
+import re
 import sys
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
-from playwright.sync_api import sync_playwright, Page, expect
+from playwright.sync_api import sync_playwright, Page, expect, TimeoutError as PlaywrightTimeoutError
 from config import Config
 
-# Setup logging
+# Logging (the directory and file are created by setup_logging() in main)
 LOG_DIR = Path("logs")
-LOG_DIR.mkdir(exist_ok=True)
-log_file = LOG_DIR / f"registration_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"
+log_file = None
+
+# Saved cookies/localStorage from the last successful login
+SESSION_FILE = LOG_DIR / ".cr_state.json"
+SESSION_MAX_AGE = 12 * 60 * 60  # seconds
+
+# Path shared by the events page and the requests that refresh its list
+EVENT_LIST_PATH = "/Online/Events/"
+
+# Patterns for reading event card text
+_SPOTS_RE = re.compile(r"\d+ of \d+ spots? remaining", re.I)
+_FREE_RE = re.compile(r"\bFREE\b", re.I)
+_FULL_RE = re.compile(r"\bFULL\b", re.I)
+
+# One buffered handle kept open for the whole run instead of reopening per line
+_LOG_FH = None
+
+# Levels that are flushed straight out so they survive a crash
+_FLUSH_LEVELS = {"ERROR", "SUCCESS"}
 
 def log(message, level="INFO"):
     """Log message to both console and file"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_line = f"[{timestamp}] [{level}] {message}"
-    print(log_line)
-    with open(log_file, "a") as f:
-        f.write(log_line + "\n")
+    log_lines([message], level)
+
+def log_lines(messages, level="INFO"):
+    """Log several messages with a single console write and a single file write"""
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    block = "\n".join(f"[{timestamp}] [{level}] {message}" for message in messages)
+    print(block)
+    if level in _FLUSH_LEVELS:
+        sys.stdout.flush()
+    if _LOG_FH is None:
+        return
+    _LOG_FH.write(block + "\n")
+    if level in _FLUSH_LEVELS:
+        _LOG_FH.flush()
+
+def setup_logging():
+    """Create the log directory and open this run's log file"""
+    global log_file, _LOG_FH
+    LOG_DIR.mkdir(exist_ok=True)
+    log_file = LOG_DIR / f"registration_{datetime.now():%Y-%m-%d_%H-%M-%S}.log"
+    _LOG_FH = open(log_file, "a", buffering=65536)
+    atexit.register(_LOG_FH.close)
+
+def is_event_list_response(response):
+    """Check if a response is an in-page (XHR/fetch) refresh of the events list"""
+    return (response.request.resource_type in ("xhr", "fetch")
+            and EVENT_LIST_PATH in response.url)
+
+def wait_for_settle(page: Page, timeout=5000):
+    """Wait until the page stops making network requests (or timeout elapses)"""
+    try:
+        page.wait_for_load_state("networkidle", timeout=timeout)
+        # networkidle only fires once per navigation; filter changes refresh
+        # the list over jQuery AJAX, so also wait for those requests to drain
+        page.wait_for_function("() => !window.jQuery || window.jQuery.active === 0", timeout=timeout)
+    except PlaywrightTimeoutError:
+        pass  # Background polling can keep the network busy; carry on
 
 def login(page: Page):
     """Login to Court Reserve"""
@@ -39,8 +91,11 @@ def login(page: Page):
     log("Submitting login...")
     page.click("button:has-text('Continue')")
 
-    # Wait for navigation after login
-    page.wait_for_timeout(3000)  # Give it time to process login
+    # Wait for navigation away from the login page
+    try:
+        page.wait_for_url(lambda url: "login" not in url.lower(), timeout=10000)
+    except PlaywrightTimeoutError:
+        pass  # Handled by the check below
 
     # Verify login success
     if "login" in page.url.lower():
@@ -48,54 +103,49 @@ def login(page: Page):
         return False
 
     log("Login successful!", "SUCCESS")
+
+    # Save the authenticated session so the next run can skip login
+    # (written to a temp file and renamed so a killed run can't leave it half-written)
+    tmp_file = SESSION_FILE.with_suffix(".tmp")
+    page.context.storage_state(path=str(tmp_file))
+    tmp_file.replace(SESSION_FILE)
     return True
 
+def has_saved_session():
+    """Check if a recent enough saved session exists"""
+    return SESSION_FILE.exists() and time.time() - SESSION_FILE.stat().st_mtime < SESSION_MAX_AGE
+
 def navigate_to_events(page: Page):
     """Navigate directly to events page"""
     log("Navigating to events page...")
     page.goto(Config.EVENTS_URL, wait_until="domcontentloaded", timeout=60000)
-    page.wait_for_timeout(2000)  # Wait for page to load
+    wait_for_settle(page, timeout=10000)
     log("Loaded events page")
 
-def apply_filters(page: Page, target_date: datetime, dry_run=False):
+def apply_filters(page: Page, target_date: datetime, time_filter: str, day_name: str, dry_run=False):
     """Apply filters for skill level, time, and price"""
     log(f"Applying filters for {target_date.strftime('%Y-%m-%d')}...")
 
-    time_filter = Config.get_time_filter(target_date)
-
     log(f"  - Target date: {target_date.strftime('%A, %B %d, %Y')}")
     log(f"  - Time preference: {time_filter}")
     log(f"  - Skill level: {Config.SKILL_LEVEL}")
 
-    page.wait_for_timeout(2000)
-
     # 1. Check skill level in Tags section
     try:
         log(f"  Checking {Config.SKILL_LEVEL} tag...")
 
-        # Find all tag checkboxes and their associated labels
-        tag_containers = page.locator('[data-testid="tags-checkbox"]').all()
-        log(f"  Found {len(tag_containers)} tag checkboxes")
-
-        found = False
-        for container in tag_containers:
-            # Get the parent div to access both checkbox and label
-            parent = container.locator('xpath=ancestor::div[contains(@class, "custom-checkbox")]')
-            # Find the badge label
-            label = parent.locator('label.badge.custom-badge')
-
-            if label.count() > 0:
-                label_text = label.inner_text().strip()
-                # Match skill level (handle variations in spacing/text)
-                if "intermediate" in label_text.lower():
-                    # Click the badge label instead of the checkbox (Kendo UI overlay issue)
-                    label.click(force=True)
-                    log(f"  ✓ {label_text} checked")
-                    page.wait_for_timeout(2000)
-                    found = True
-                    break
-
-        if not found:
+        # Target the Intermediate badge label directly within the tag checkboxes
+        label = page.locator(
+            'div.custom-checkbox:has([data-testid="tags-checkbox"]) label.badge.custom-badge',
+            has_text="Intermediate",
+        ).first
+
+        if label.count() > 0:
+            label_text = label.inner_text().strip()
+            # Click the badge label instead of the checkbox (Kendo UI overlay issue)
+            label.click(force=True)
+            log(f"  ✓ {label_text} checked")
+        else:
             log(f"  ⚠ Could not find Intermediate tag", "WARNING")
     except Exception as e:
         log(f"  ⚠ Error checking skill level: {e}", "WARNING")
@@ -112,7 +162,6 @@ def apply_filters(page: Page, target_date: datetime, dry_run=False):
             if this_month_radio.count() > 0:
                 this_month_radio.click(force=True)
                 log("  ✓ 'This Month' selected")
-                page.wait_for_timeout(2000)
             else:
                 log("  ⚠ Could not find 'This Month' radio", "WARNING")
         else:
@@ -122,7 +171,6 @@ def apply_filters(page: Page, target_date: datetime, dry_run=False):
 
     # 2b. Select Day of Week
     try:
-        day_name = target_date.strftime("%A")  # e.g., "Sunday"
         log(f"  Selecting day of week: {day_name}...")
 
         # Map day names to data-testid or checkbox IDs
@@ -132,7 +180,6 @@ def apply_filters(page: Page, target_date: datetime, dry_run=False):
         if day_checkbox.count() > 0:
             day_checkbox.check(force=True)
             log(f"  ✓ {day_name} selected")
-            page.wait_for_timeout(2000)
         else:
             log(f"  ⚠ Could not find {day_name} checkbox", "WARNING")
     except Exception as e:
@@ -155,7 +202,6 @@ def apply_filters(page: Page, target_date: datetime, dry_run=False):
             if time_checkbox.count() > 0:
                 time_checkbox.check(force=True)
                 log(f"  ✓ {time_filter} checked")
-                page.wait_for_timeout(2000)
             else:
                 log(f"  ⚠ Could not find {time_filter} checkbox", "WARNING")
         else:
@@ -167,94 +213,125 @@ def apply_filters(page: Page, target_date: datetime, dry_run=False):
     try:
         log("  Setting price range to $0 (FREE only)...")
 
-        # Use JavaScript to set slider values directly
-        page.evaluate("""
-            const slider = document.getElementById('eventFilterPriceRange');
-            if (slider) {
-                // Move both slider handles to the left (value 0)
-                const handles = slider.querySelectorAll('.ui-slider-handle');
-                handles.forEach(handle => {
-                    handle.style.left = '0%';
-                });
-
-                // Update the range bar
-                const range = slider.querySelector('.ui-slider-range');
-                if (range) {
-                    range.style.left = '0%';
-                    range.style.width = '0%';
+        # Let the earlier filters' refreshes finish so they can't be mistaken
+        # for the one the slider triggers
+        wait_for_settle(page)
+
+        # Use JavaScript to set slider values directly, and wait for the
+        # events list refresh it triggers so we know the filters were applied
+        with page.expect_response(is_event_list_response, timeout=8000):
+            page.evaluate("""
+                const slider = document.getElementById('eventFilterPriceRange');
+                if (slider) {
+                    // Move both slider handles to the left (value 0)
+                    const handles = slider.querySelectorAll('.ui-slider-handle');
+                    handles.forEach(handle => {
+                        handle.style.left = '0%';
+                    });
+
+                    // Update the range bar
+                    const range = slider.querySelector('.ui-slider-range');
+                    if (range) {
+                        range.style.left = '0%';
+                        range.style.width = '0%';
+                    }
+
+                    // Trigger change event to update the page
+                    const event = new Event('slidechange');
+                    slider.dispatchEvent(event);
                 }
+            """)
 
-                // Trigger change event to update the page
-                const event = new Event('slidechange');
-                slider.dispatchEvent(event);
-            }
-        """)
-
-        page.wait_for_timeout(2000)
         log("  ✓ Price range set to $0")
+    except PlaywrightTimeoutError:
+        log("  ⚠ Event list did not refresh after setting price range", "WARNING")
     except Exception as e:
         log(f"  ⚠ Error setting price range: {e}", "WARNING")
 
+    # Let any refreshes still in flight from the earlier filters finish too
+    wait_for_settle(page, timeout=8000)
     log("Filters applied!")
 
     # Pause to verify filters
     # log("Pausing for verification... Press Continue in Playwright Inspector")
     # page.pause()
 
-def find_and_register_events(page: Page, target_date: datetime, dry_run=False):
+def find_and_register_events(page: Page, target_date: datetime, dry_run=False, screenshots=True):
     """Find matching FREE events and register"""
     log(f"Looking for FREE events on {target_date.strftime('%b %d, %Y')}...")
 
     # Wait for events to load after filters
-    page.wait_for_timeout(2000)
-
-    # Find all visible event cards
-    events = page.locator("article, [class*='event'], [class*='program']").all()
-
-    if not events:
-        log("No events found on page", "WARNING")
+    wait_for_settle(page)
+
+    # Match the target date line once per run (e.g., "Sun, Mar 8th 9:00 AM")
+    date_pattern = re.compile(
+        rf"{re.escape(target_date.strftime('%a, %b'))} {target_date.day}(?:st|nd|rd|th)?\b[^\n]*"
+    )
+
+    # Read the event cards for the target date in a single round-trip
+    # (date filter runs in the browser so other cards never cross over)
+    event_cards = page.locator("article, [class*='event'], [class*='program']")
+    events_data = event_cards.evaluate_all("""(elements, datePattern) => {
+        const dateRe = new RegExp(datePattern);
+        const heading = 'h1, h2, h3, h4';
+        // Wrappers such as the list itself also match the card selector, so
+        // keep only the innermost matches that still have their own title
+        const isCard = el => el.querySelector(heading) && !elements.some(
+            other => other !== el && el.contains(other) && other.querySelector(heading));
+        return elements.map((el, i) => ({el, i}))
+            .filter(({el}) => isCard(el) && dateRe.test(el.innerText || ''))
+            .map(({el, i}) => {
+                // Tag the card so it can be found again for clicking
+                el.dataset.crIdx = i;
+                return {
+                    idx: i,
+                    title: el.querySelector(heading).innerText.trim(),
+                    text: el.innerText || '',
+                };
+            });
+    }
+    """, date_pattern.pattern)
+
+    if not events_data:
+        log("No events found on target date", "WARNING")
         return []
 
-    log(f"Found {len(events)} events, filtering for target date...")
+    log(f"Found {len(events_data)} events on target date, checking price...")
 
     registered = []
 
-    for i, event in enumerate(events):
+    for data in events_data:
+        i = data["idx"]
         try:
             # Get event title
-            title_elem = event.locator("h1, h2, h3, h4").first
-            if title_elem.count() == 0:
+            if not data["title"]:
                 continue
-            title = title_elem.inner_text().strip()
+            title = data["title"]
 
             # Get date/time
-            date_time_elem = event.locator("text=/[A-Z][a-z]{2}, [A-Z][a-z]{2}/").first
-            if date_time_elem.count() == 0:
+            date_match = date_pattern.search(data["text"])
+            if not date_match:
                 continue
-            date_time = date_time_elem.inner_text().strip()
-
-            # Filter by target date (e.g., "Sun, Mar 8th")
-            target_date_str = target_date.strftime("%a, %b %-d")  # e.g., "Sun, Mar 8"
-            # Handle "8th", "21st", etc. - just check if date_time starts with day and month
-            if not (target_date_str in date_time or
-                    target_date.strftime("%a, %b %-dst") in date_time or
-                    target_date.strftime("%a, %b %-dnd") in date_time or
-                    target_date.strftime("%a, %b %-drd") in date_time or
-                    target_date.strftime("%a, %b %-dth") in date_time):
-                continue  # Skip events not on target date
+            date_time = date_match.group().strip()
 
             # Check if FREE (skip paid events)
-            price_elem = event.locator("text=/FREE/i")
-            if price_elem.count() == 0:
+            if not _FREE_RE.search(data["text"]):
                 log(f"  Skipping (paid): {title}")
                 continue
 
+            # Only matching events need a live locator for clicking; the tag is
+            # gone if the list re-rendered since the read
+            event = page.locator(f'[data-cr-idx="{i}"]')
+            if event.count() == 0:
+                log(f"  ⚠ Event card no longer on page: {title}", "WARNING")
+                continue
+
             log(f"\n✓ Found FREE event:")
             log(f"  Title: {title}")
             log(f"  Date/Time: {date_time}")
 
             # Check availability
-            if event.locator("text=/FULL/i").count() > 0:
+            if _FULL_RE.search(data["text"]):
                 log("  Status: FULL")
 
                 if dry_run:
@@ -264,17 +341,16 @@ def find_and_register_events(page: Page, target_date: datetime, dry_run=False):
                     waitlist_btn = event.locator("button:has-text('Join Waitlist')")
                     if waitlist_btn.count() > 0:
                         waitlist_btn.click()
-                        page.wait_for_timeout(1000)
+                        wait_for_settle(page)
                         log("  ✓ Joined waitlist!", "SUCCESS")
                         registered.append({"title": title, "date": date_time, "status": "waitlisted"})
                     else:
                         log("  ⚠ No waitlist button", "WARNING")
             else:
                 # Check for available spots
-                spots_elem = event.locator("text=/\\d+ of \\d+ spots? remaining/i")
-                if spots_elem.count() > 0:
-                    spots = spots_elem.inner_text()
-                    log(f"  Status: {spots}")
+                spots_match = _SPOTS_RE.search(data["text"])
+                if spots_match:
+                    log(f"  Status: {spots_match.group()}")
 
                 if dry_run:
                     log("  [DRY RUN] Would register")
@@ -294,8 +370,16 @@ def find_and_register_events(page: Page, target_date: datetime, dry_run=False):
 
                     # Click the register button (goes to details page)
                     if register_btn.count() > 0:
+                        list_url = page.url
                         register_btn.first.click()
-                        page.wait_for_timeout(3000)  # Wait for details page to load
+
+                        # Wait to leave the list page, then for the details page's Register button
+                        try:
+                            page.wait_for_url(lambda url: url != list_url, timeout=10000)
+                            page.wait_for_selector('[data-testid="register-btn"]', timeout=10000)
+                        except PlaywrightTimeoutError:
+                            log("  ⚠ Details page did not load", "WARNING")
+                            continue
 
                         # Pause to verify details page
                         # log("On event details page. Verify and press Continue...")
@@ -306,22 +390,47 @@ def find_and_register_events(page: Page, target_date: datetime, dry_run=False):
 
                         if final_register_btn.count() > 0:
                             final_register_btn.click()
-                            page.wait_for_timeout(3000)  # Wait for confirmation page
+
+                            # Wait for confirmation page
+                            try:
+                                page.wait_for_selector('button:has-text("Finalize Registration")', timeout=10000)
+                            except PlaywrightTimeoutError:
+                                pass  # Reported below
 
                             # Click "Finalize Registration" button on confirmation page
                             finalize_btn = page.locator('button:has-text("Finalize Registration")')
                             if finalize_btn.count() > 0:
+                                # Count success text already on the page so only new text counts
+                                shown_before = page.evaluate(
+                                    "() => ((document.body ? document.body.innerText : '')"
+                                    ".match(/confirmation|success/gi) || []).length"
+                                )
                                 finalize_btn.click()
-                                page.wait_for_timeout(10000)  # Wait for success page to load
 
-                                # Take screenshot of confirmation page
-                                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                screenshot_path = f"logs/registration_success_{timestamp}.png"
-                                page.screenshot(path=screenshot_path)
-                                log(f"  📸 Screenshot saved: {screenshot_path}")
+                                # Success may be a new page or a modal/inline message on this one:
+                                # wait for new success text, or for the Finalize button to go away
+                                # with success text on the page that replaced it
+                                try:
+                                    page.wait_for_function("""(before) => {
+                                        const text = document.body ? document.body.innerText : '';
+                                        const shown = (text.match(/confirmation|success/gi) || []).length;
+                                        const finalizeGone = !Array.from(document.querySelectorAll('button'))
+                                            .some(b => b.innerText.includes('Finalize Registration'));
+                                        return shown > before || (finalizeGone && shown > 0);
+                                    }""", arg=shown_before, timeout=15000)
+                                except PlaywrightTimeoutError:
+                                    log("  ⚠ Could not confirm registration was finalized", "WARNING")
+                                    continue
 
                                 log("  ✓ Successfully registered!", "SUCCESS")
                                 registered.append({"title": title, "date": date_time, "status": "registered"})
+
+                                # Take screenshot of confirmation page
+                                if screenshots:
+                                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                                    screenshot_path = f"logs/registration_success_{timestamp}.jpg"
+                                    page.screenshot(path=screenshot_path, type="jpeg", quality=60)
+                                    log(f"  📸 Screenshot saved: {screenshot_path}")
                             else:
                                 log("  ⚠ Could not find Finalize Registration button", "WARNING")
                         else:
@@ -343,9 +452,21 @@ def main():
     parser.add_argument("--dry-run", action="store_true", help="Show what would be registered without actually registering")
     parser.add_argument("--date", help="Specific date to check (YYYY-MM-DD), defaults to 21 days from now")
     parser.add_argument("--headless", action="store_true", help="Run browser in headless mode")
+    parser.add_argument("--screenshots", action=argparse.BooleanOptionalAction, default=None,
+                        help="Save a screenshot after each registration (default: on unless --headless)")
 
     args = parser.parse_args()
 
+    setup_logging()
+
+    # Headless runs are unattended, so let stdout batch its writes too
+    if args.headless:
+        sys.stdout.reconfigure(line_buffering=False)
+
+    # Nobody is watching headless runs, so skip screenshots unless asked
+    if args.screenshots is None:
+        args.screenshots = not args.headless
+
     # Validate configuration
     try:
         Config.validate()
@@ -360,6 +481,10 @@ def main():
     else:
         target_date = Config.get_target_date()
 
+    # Derive the date-dependent filter values once for the whole run
+    time_filter = Config.get_time_filter(target_date)
+    day_name = target_date.strftime("%A")  # e.g., "Sunday"
+
     log("=" * 60)
     log("Court Reserve Auto-Registration")
     log("=" * 60)
@@ -371,41 +496,68 @@ def main():
 
     with sync_playwright() as p:
         # Launch browser
-        browser = p.chromium.launch(headless=args.headless)
-        context = browser.new_context()
+        browser = p.chromium.launch(
+            headless=args.headless,
+            args=[
+                "--blink-settings=imagesEnabled=false",  # Only DOM text and click targets are needed
+                "--disable-blink-features=AutomationControlled",
+                "--disable-dev-shm-usage",
+            ],
+        )
+
+        # Reuse the saved session if there is one
+        use_saved_session = has_saved_session()
+        if use_saved_session:
+            try:
+                context = browser.new_context(storage_state=str(SESSION_FILE))
+            except Exception as e:
+                log(f"Could not load saved session, logging in fresh: {e}", "WARNING")
+                SESSION_FILE.unlink(missing_ok=True)
+                use_saved_session = False
+        if not use_saved_session:
+            context = browser.new_context()
         page = context.new_page()
 
-        # Set default timeout to 60 seconds
-        page.set_default_timeout(60000)
+        # Fail fast on missing elements; page loads pass their own longer timeouts
+        page.set_default_timeout(5000)
 
         try:
-            # Login
-            if not login(page):
+            # Login (skipped when the saved session is still valid)
+            if use_saved_session:
+                log("Reusing saved session")
+            elif not login(page):
                 log("Exiting due to login failure", "ERROR")
                 sys.exit(1)
 
             # Navigate to Events page
             navigate_to_events(page)
 
+            # Saved session expired - log in again and retry
+            if use_saved_session and "login" in page.url.lower():
+                log("Saved session expired, logging in again...")
+                if not login(page):
+                    log("Exiting due to login failure", "ERROR")
+                    sys.exit(1)
+                navigate_to_events(page)
+
             # Apply filters
-            apply_filters(page, target_date, args.dry_run)
+            apply_filters(page, target_date, time_filter, day_name, args.dry_run)
 
             # Find and register for events
-            registered = find_and_register_events(page, target_date, args.dry_run)
+            registered = find_and_register_events(page, target_date, args.dry_run, args.screenshots)
 
-            # Summary
-            log("\n" + "=" * 60)
-            log("REGISTRATION SUMMARY")
-            log("=" * 60)
+            # Summary (built in memory and written in one go)
+            summary = ["\n" + "=" * 60, "REGISTRATION SUMMARY", "=" * 60]
 
             if registered:
                 for event in registered:
-                    log(f"✓ {event['status'].upper()}: {event['title']}")
-                    log(f"  {event['date']}")
+                    summary.append(f"✓ {event['status'].upper()}: {event['title']}")
+                    summary.append(f"  {event['date']}")
             else:
-                log("No events were registered")
+                summary.append("No events were registered")
 
-            log(f"\nLog file: {log_file}")
+            summary.append(f"\nLog file: {log_file}")
+            log_lines(summary)
 
         except Exception as e:
             log(f"Unexpected error: {str(e)}", "ERROR")